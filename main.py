@@ -4,19 +4,42 @@ Trojan Telegram Bot - Solana Trading Interface Simulator
 A Telegram bot that simulates Trojan's Solana trading interface with team address assignment and referral system.
 """
 
+__all__ = ['TrojanBot', 'User', 'main']
+
+import asyncio
+import importlib.util
+import itertools
 import logging
 import os
-import random
 import json
+import sqlite3
+import sys
+from collections import OrderedDict
+from contextlib import suppress
+from dataclasses import dataclass, fields
 from datetime import datetime
-from typing import Dict, List, Optional
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, Final, Iterable, Iterator, List, Literal, Optional, Set, Tuple, TypeVar
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import CallbackQuery, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, TelegramError
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 
-# Load environment variables
+try:
+    import orjson  # Faster JSON parsing for the legacy import, if installed
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+try:
+    import uvloop  # libuv-based event loop, if installed
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
+# Load environment variables; values already set in the environment take precedence over .env
 load_dotenv()
 
 # Enable logging
@@ -31,82 +54,533 @@ TEAMS = {
     'Team 1': '8rMj1dMR6tp428j7DaGUn6TpLi89fpdYNQEwqUzyFCe3',
     'Team 2': 'EATAgjcHTZxCaudus4VvktLRfxYjtHMbNLSnyDJYXtnt'
 }
+# Every user shares one of these addresses, so keep a single copy of each string
+for _team_name, _team_address in TEAMS.items():
+    TEAMS[_team_name] = sys.intern(_team_address)
+# Assignment order: even registrations get Team 1, odd ones Team 2
+TEAM_ROTATION = (TEAMS['Team 1'], TEAMS['Team 2'])
+
+# HTTP/2 lets concurrent Bot API calls share one connection; it needs the optional h2 package
+HTTP_VERSION: Literal['1.1', '2'] = "2" if importlib.util.find_spec("h2") else "1.1"
+# Concurrent Bot API requests allowed to the Telegram server
+CONNECTION_POOL_SIZE = 256
+# Seconds a request waits for a free pooled connection before failing fast
+POOL_TIMEOUT = 5.0
 
 # Bot username for referral links
 BOT_USERNAME = os.getenv('BOT_USERNAME', 'Thanatos_TrojanBot')
+# Referral links are this prefix followed by the referrer's Telegram id
+REFERRAL_LINK_PREFIX: Final[str] = f"https://t.me/{BOT_USERNAME}?start=ref_"
 
-# File-based storage for users
-USER_DATA_FILE = "users.json"
-users_db: Dict[str, Dict] = {}
-used_addresses = set()
+# Public HTTPS base URL; when set, Telegram pushes updates to a webhook instead of being polled
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+
+# Main menu header; only the address and balance vary per user
+MAIN_MENU_TEMPLATE: Final[str] = """Solana • 🅴 <code>{team_address}</code> (Tap to Copy)  
+Balance: {sol_balance} SOL ($0.00)
+
+Click on the Refresh button to update your current balance.
+
+⚠️We have no control over ads shown by Telegram in this bot. Do not be scammed by fake airdrops or login pages."""
+
+# Rewards caption; fields are filled per user with str.format_map
+REWARDS_TEMPLATE: Final[str] = """Cashback and Referral Rewards are paid out <b>every 12 hours</b> and airdropped directly to your Rewards Wallet. To be eligible, you must have at least 0.005 SOL in unpaid rewards.
+
+<b>All Trojan users now enjoy a 10% boost to referral rewards and 20% cashback on trading fees.</b>
+
+Referral Rewards  
+• Users referred: {total_referred}
+• Direct: {user.direct_referrals}, Indirect: {user.indirect_referrals}  
+• Earned rewards: {user.referral_rewards:.3f} SOL ($0.00)
 
-def load_users():
-    """Load users from JSON file"""
-    global users_db, used_addresses
+Cashback Rewards  
+• Earned rewards: {user.cashback_rewards:.3f} SOL ($0.00)
+
+Total Rewards  
+• Total paid: {user.total_paid_rewards:.3f} SOL ($0.00)  
+• Total unpaid: {total_unpaid:.3f} SOL ($0.00)
+
+<b>Your Referral Link</b>
+<code>{referral_link}</code>
+Your friends save 10% with your link.
+
+Last updated at {formatted_time} (every 5 min)"""
+
+# Minute-precision timestamp shown at the bottom of the rewards caption
+REWARDS_TIME_FORMAT: Final[str] = "%Y-%m-%d %H:%M UTC"
+REWARDS_PHOTO_PATH = "attached_assets/trojan_referral_1754228938867.jpg"
+
+# Per-user screens; fields are filled with str.format
+BUY_TEMPLATE: Final[str] = """💰 <b>Buy Tokens</b>
+
+Welcome to the buying interface! Here you can purchase various Solana tokens.
+
+Your wallet: <code>{user.team_address}</code>
+Balance: {user.sol_balance} SOL
+
+To start trading, you need to deposit SOL to your wallet address above."""
+# Feature screens that stay locked until the user deposits; "{{user.team_address}}" survives the first format
+DEPOSIT_GATE_TEMPLATE: Final[str] = """{title}
+
+{description}
+
+You need to deposit at least 1 SOL to access this feature.
+<code>{{user.team_address}}</code> (tap to copy)"""
+COPY_TRADE_TEMPLATE: Final[str] = DEPOSIT_GATE_TEMPLATE.format(title="👥 <b>Copy Trading</b>", description="Copy successful traders' strategies automatically.")
+SNIPER_TEMPLATE: Final[str] = DEPOSIT_GATE_TEMPLATE.format(title="🎯 <b>Sniper 🆕</b>", description="Automatically buy tokens as soon as they launch.")
+TRENCHES_TEMPLATE: Final[str] = DEPOSIT_GATE_TEMPLATE.format(title="🏴 <b>Trenches</b>", description="Advanced trading tools for experienced traders.")
+WATCHLIST_TEMPLATE: Final[str] = DEPOSIT_GATE_TEMPLATE.format(title="⭐ <b>Watchlist</b>", description="Keep track of your favorite tokens and get price alerts.")
+WITHDRAW_TEMPLATE: Final[str] = DEPOSIT_GATE_TEMPLATE.format(title="💳 <b>Withdraw</b>", description="Withdraw your SOL and tokens to external wallets.")
+SETTINGS_TEMPLATE: Final[str] = DEPOSIT_GATE_TEMPLATE.format(title="⚙️ <b>Settings</b>", description="Configure your trading preferences and security settings.")
+
+# Static screens; built once at import and sent as-is
+NO_TOKENS_MESSAGE: Final[str] = "<b>You do not have any tokens yet! Start trading in the Buy menu.</b>"
+NO_LIMIT_ORDERS_MESSAGE: Final[str] = "<b>You have no active limit orders. Create a limit order from the Buy/Sell menu.</b>"
+NO_DCA_ORDERS_MESSAGE: Final[str] = "<b>You have no active DCA orders. Create a DCA order from the Buy/Sell menu.</b>"
+HELP_MESSAGE: Final[str] = """<b>Where can I find my referral code?</b>  
+Open the /start menu and click 💰Referrals.
+
+<b>What are the fees for using Trojan?</b>  
+Successful transactions through Trojan incur a fee of 0.9% if you were referred by another user. We don't charge a subscription fee or pay-wall any features.
+
+<b>Security Tips: How can I protect my account from scammers?</b>  
+- Safeguard does NOT require you to login with a phone number or QR code!  
+- NEVER search for bots in Telegram. Use only official links.  
+- Admins and Mods NEVER DM first or send links. Stay safe!
+
+<b>Extra Protection:</b>  
+Setup your Secure Action Password (SAP) in the Settings menu. You'll need this password to withdraw, export keys, or delete a wallet. It is NOT recoverable, so set a hint.
+
+<b>Trading Tips: Common Failure Reasons</b>  
+- Slippage Exceeded: Increase slippage or reduce your order size.  
+- Insufficient Balance: Add SOL or reduce the transaction amount.  
+- Timeout: Can happen under high network load. Try higher gas tip.
+
+<b>PNL seems wrong?</b>  
+Trade net profit includes gas fees. Check Solscan.io to confirm."""
+SET_WALLET_MESSAGE: Final[str] = "💳 <b>Set Rewards Wallet</b>\n\nEnter your destination wallet for referral rewards:"
+UNKNOWN_ACTION_MESSAGE: Final[str] = "Unknown action."
+
+# Keyboards are immutable, so they are built once and shared by all messages
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Buy", callback_data="buy"),
+        InlineKeyboardButton("Sell", callback_data="sell")
+    ],
+    [
+        InlineKeyboardButton("Positions", callback_data="positions"),
+        InlineKeyboardButton("Limit Orders", callback_data="limit_orders"),
+        InlineKeyboardButton("DCA Orders", callback_data="dca_orders")
+    ],
+    [
+        InlineKeyboardButton("Copy Trade", callback_data="copy_trade"),
+        InlineKeyboardButton("Sniper 🆕", callback_data="sniper")
+    ],
+    [
+        InlineKeyboardButton("Trenches", callback_data="trenches"),
+        InlineKeyboardButton("💰 Rewards", callback_data="rewards"),
+        InlineKeyboardButton("⭐ Watchlist", callback_data="watchlist")
+    ],
+    [
+        InlineKeyboardButton("Withdraw", callback_data="withdraw"),
+        InlineKeyboardButton("Settings", callback_data="settings")
+    ],
+    [
+        InlineKeyboardButton("Help", callback_data="help"),
+        InlineKeyboardButton("Refresh", callback_data="refresh")
+    ]
+])
+BACK_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("← Back", callback_data="back_to_main")]])
+CANCEL_TO_REWARDS_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("← Cancel", callback_data="rewards")]])
+
+@lru_cache(maxsize=1024)
+def rewards_markup(rewards_wallet: str, wallet_first: bool) -> InlineKeyboardMarkup:
+    """Rewards keyboard for a wallet; most users share a team address, so these are reused"""
+    # Truncated wallet address for display (first 4 + ... + last 4)
+    wallet_row = [InlineKeyboardButton(f"Rewards Wallet: {rewards_wallet[:4]}...{rewards_wallet[-4:]}", callback_data="set_rewards_wallet")]
+    refresh_row = [InlineKeyboardButton("Refresh", callback_data="rewards")]
+    top_rows = [wallet_row, refresh_row] if wallet_first else [refresh_row, wallet_row]
+    return InlineKeyboardMarkup(top_rows + [[InlineKeyboardButton("← Back", callback_data="back_to_main")]])
+
+@lru_cache(maxsize=1)
+def format_minute(minute: datetime) -> str:
+    """Rewards timestamp for a whole minute; every message rendered in that minute reuses it"""
+    return minute.strftime(REWARDS_TIME_FORMAT)
+
+@dataclass(slots=True)
+class User:
+    """A registered user; slots keep per-user memory small"""
+    telegram_id: int
+    username: str
+    team_address: str
+    rewards_wallet: Optional[str] = None
+    referred_by: Optional[int] = None
+    direct_referrals: int = 0
+    indirect_referrals: int = 0
+    sol_balance: float = 0.0
+    referral_rewards: float = 0.0
+    cashback_rewards: float = 0.0
+    total_paid_rewards: float = 0.0
+    created_at: Optional[datetime] = None
+    last_updated: Optional[datetime] = None
+
+K = TypeVar('K')
+V = TypeVar('V')
+
+class LRUCache(OrderedDict[K, V]):
+    """Dict that drops its least recently used entries beyond maxsize"""
+
+    def __init__(self, maxsize: int) -> None:
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key: K) -> V:
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:  # type: ignore[override]
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key: K, value: V) -> None:
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self._evict()
+
+    def _evict(self) -> None:
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+class UserCache(LRUCache[int, User]):
+    """LRU cache of users that keeps records with unsaved changes until they are flushed"""
+
+    def __init__(self, maxsize: int) -> None:
+        super().__init__(maxsize)
+        self.dirty: Set[int] = set()
+        # Users taken by a flush that has not finished writing yet
+        self.flushing: Set[int] = set()
+
+    def _evict(self) -> None:
+        while len(self) > self.maxsize:
+            # Oldest entry that is safe to drop; unsaved ones would lose their changes
+            key = next((key for key in self if key not in self.dirty and key not in self.flushing), None)
+            if key is None:
+                return
+            del self[key]
+
+    def take_dirty(self) -> List[User]:
+        """Return the users with unsaved changes and hold them until finish_flush()"""
+        self.flushing, self.dirty = self.dirty, set()
+        return [OrderedDict.__getitem__(self, telegram_id) for telegram_id in self.flushing]
+
+    def finish_flush(self, saved: bool) -> None:
+        """Release flushed users, or mark them dirty again if the write failed"""
+        if not saved:
+            self.dirty |= self.flushing
+        self.flushing = set()
+
+# SQLite-backed storage for users
+USER_DB_FILE = "users.db"
+# Legacy JSON store, imported into the database on first start
+USER_DATA_FILE = "users.json"
+USER_COLUMNS = tuple(field.name for field in fields(User))
+UPSERT_USER_SQL = (
+    f"INSERT OR REPLACE INTO users ({', '.join(USER_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(USER_COLUMNS))})"
+)
+SELECT_USER_SQL = f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE telegram_id = ?"
+# Dirty user records are written in batches after a short delay to coalesce bursts
+FLUSH_DELAY = 0.5
+FLUSH_BATCH_SIZE = 500
+# Maximum number of users kept in memory; the database is the source of truth
+USER_CACHE_SIZE = 50_000
+# WAL pages written before they are checkpointed into users.db, and the size the WAL is cut back to
+WAL_AUTOCHECKPOINT = 1000
+WAL_SIZE_LIMIT = 4 * 1024 * 1024
+_db: Optional[sqlite3.Connection] = None
+# In-memory cache of user rows, filled on demand from the database
+users_db = UserCache(USER_CACHE_SIZE)
+
+def _conn() -> sqlite3.Connection:
+    """The open user database; load_users() must have run first"""
+    assert _db is not None, "load_users() has not been called"
+    return _db
+
+def load_users() -> int:
+    """Open the user database, import legacy JSON data if needed and return the user count"""
+    global _db
+    # Writes happen on a worker thread, reads on the event loop thread
+    _db = sqlite3.connect(USER_DB_FILE, check_same_thread=False)
+    _db.row_factory = sqlite3.Row
+    _db.execute("PRAGMA journal_mode=WAL")
+    _db.execute("PRAGMA synchronous=NORMAL")
+    # Changes are appended to the WAL and checkpointed into the main file every
+    # WAL_AUTOCHECKPOINT pages; the limit truncates the WAL back down afterwards
+    _db.execute(f"PRAGMA wal_autocheckpoint={WAL_AUTOCHECKPOINT}")
+    _db.execute(f"PRAGMA journal_size_limit={WAL_SIZE_LIMIT}")
+    _db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id INTEGER PRIMARY KEY,
+            username TEXT,
+            team_address TEXT NOT NULL,
+            rewards_wallet TEXT,
+            referred_by INTEGER,
+            direct_referrals INTEGER NOT NULL DEFAULT 0,
+            indirect_referrals INTEGER NOT NULL DEFAULT 0,
+            sol_balance REAL NOT NULL DEFAULT 0,
+            referral_rewards REAL NOT NULL DEFAULT 0,
+            cashback_rewards REAL NOT NULL DEFAULT 0,
+            total_paid_rewards REAL NOT NULL DEFAULT 0,
+            created_at TEXT,
+            last_updated TEXT
+        )""")
+    _db.commit()
+
+    if _db.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None and os.path.exists(USER_DATA_FILE):
+        import_legacy_users()
+
+    user_count = _db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    logger.info("Opened user database with %s users", user_count)
+    return user_count
+
+def import_legacy_users() -> None:
+    """Import users from the legacy JSON file into the database"""
     try:
-        if os.path.exists(USER_DATA_FILE):
-            with open(USER_DATA_FILE, 'r') as f:
-                data = json.load(f)
-                users_db = data.get('users', {})
-                used_addresses = set(data.get('used_addresses', []))
-                
-                # Migration: Add rewards_wallet field to existing users
-                migration_needed = False
-                for user_id, user_data in users_db.items():
-                    if 'rewards_wallet' not in user_data:
-                        user_data['rewards_wallet'] = user_data['team_address']
-                        migration_needed = True
-                
-                if migration_needed:
-                    save_users()
-                    logger.info("Migrated existing users to include rewards_wallet field")
-                
-                logger.info(f"Loaded {len(users_db)} users from storage")
-        else:
-            users_db = {}
-            used_addresses = set()
-            logger.info("No existing user data found, starting fresh")
-    except Exception as e:
-        logger.error(f"Error loading users: {e}")
-        users_db = {}
-        used_addresses = set()
+        with open(USER_DATA_FILE, 'rb') as f:
+            raw = f.read()
+        data = orjson.loads(raw) if orjson else json.loads(raw)
+    except (OSError, ValueError) as e:  # Unreadable file or invalid JSON
+        logger.error("Error loading legacy users: %s", e)
+        return
+
+    users = data.get('users', {})
+    db = _conn()
+    with db:
+        for user_data in users.values():
+            # Migration: Add rewards_wallet field to existing users
+            user_data.setdefault('rewards_wallet', user_data['team_address'])
+            # The JSON store kept Telegram ids as strings
+            user_data['telegram_id'] = int(user_data['telegram_id'])
+            if user_data.get('referred_by'):
+                user_data['referred_by'] = int(user_data['referred_by'])
+            db.execute(UPSERT_USER_SQL, tuple(user_data.get(column) for column in USER_COLUMNS))
+    logger.info("Imported %s users from %s", len(users), USER_DATA_FILE)
+
+# One users table row, in USER_COLUMNS order
+UserRow = Tuple[
+    int, str, str, Optional[str], Optional[int], int, int,
+    float, float, float, float, Optional[str], Optional[str]
+]
+
+def _user_row(user_data: User) -> UserRow:
+    """Convert a user record to a database row"""
+    return (
+        user_data.telegram_id, user_data.username, user_data.team_address, user_data.rewards_wallet,
+        user_data.referred_by, user_data.direct_referrals, user_data.indirect_referrals,
+        user_data.sol_balance, user_data.referral_rewards, user_data.cashback_rewards,
+        user_data.total_paid_rewards,
+        str(user_data.created_at) if user_data.created_at else None,
+        str(user_data.last_updated) if user_data.last_updated else None
+    )
+
+def _user_from_row(row: sqlite3.Row) -> User:
+    """Convert a database row to a user record, parsing timestamps and interning addresses"""
+    rewards_wallet = row['rewards_wallet']
+    created_at = row['created_at']
+    last_updated = row['last_updated']
+    return User(
+        telegram_id=row['telegram_id'],
+        username=row['username'],
+        team_address=sys.intern(row['team_address']),
+        rewards_wallet=sys.intern(rewards_wallet) if rewards_wallet else None,
+        referred_by=row['referred_by'],
+        direct_referrals=row['direct_referrals'],
+        indirect_referrals=row['indirect_referrals'],
+        sol_balance=row['sol_balance'],
+        referral_rewards=row['referral_rewards'],
+        cashback_rewards=row['cashback_rewards'],
+        total_paid_rewards=row['total_paid_rewards'],
+        created_at=datetime.fromisoformat(created_at) if created_at else None,
+        last_updated=datetime.fromisoformat(last_updated) if last_updated else None
+    )
+
+def get_user(telegram_id: int) -> Optional[User]:
+    """Get a user record, loading it from the database on a cache miss"""
+    user_data = users_db.get(telegram_id)
+    if user_data is None:
+        row = _conn().execute(SELECT_USER_SQL, (telegram_id,)).fetchone()
+        if row is None:
+            return None
+        user_data = _user_from_row(row)
+        users_db[telegram_id] = user_data
+    return user_data
+
+def add_user(user_data: User) -> None:
+    """Add a newly registered user to the cache"""
+    users_db[user_data.telegram_id] = user_data
+
+def checkpoint_users() -> None:
+    """Fold the WAL into the main database file and truncate it"""
+    try:
+        _conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    except sqlite3.Error as e:
+        logger.error("Error checkpointing users: %s", e)
 
-def save_users():
-    """Save users to JSON file"""
+def save_users(rows: Iterable[UserRow]) -> bool:
+    """Write a batch of user rows to the database in one transaction"""
     try:
-        data = {
-            'users': users_db,
-            'used_addresses': list(used_addresses),
-            'last_updated': datetime.now().isoformat()
-        }
-        with open(USER_DATA_FILE, 'w') as f:
-            json.dump(data, f, indent=2, default=str)
-        logger.info(f"Saved {len(users_db)} users to storage")
-    except Exception as e:
-        logger.error(f"Error saving users: {e}")
+        db = _conn()
+        with db:
+            db.executemany(UPSERT_USER_SQL, rows)
+        return True
+    except sqlite3.Error as e:
+        logger.error("Error saving users: %s", e)
+        return False
 
 class TrojanBot:
-    def __init__(self):
-        self.token = os.getenv('BOT_TOKEN')
-        if not self.token:
+    def __init__(self) -> None:
+        token = os.getenv('BOT_TOKEN')
+        if not token:
             raise ValueError("BOT_TOKEN environment variable is required")
+        self.token: str = token
         
         # Load existing user data
-        load_users()
+        user_count = load_users()
+        
+        # Team addresses in assignment order, advanced past the users already registered
+        self._team_cycle: Iterator[str] = itertools.cycle(TEAM_ROTATION)
+        for _ in range(user_count % len(TEAM_ROTATION)):
+            next(self._team_cycle)
+        
+        # Set when users_db has changes waiting to be flushed
+        self._dirty_event = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._save_lock = asyncio.Lock()
+        
+        # Rewards photo, read once; after its first upload Telegram's file_id is sent instead
+        self._rewards_photo_file_id: Optional[str] = None
+        self._rewards_photo_bytes: Optional[bytes] = None
+        try:
+            with open(REWARDS_PHOTO_PATH, 'rb') as f:
+                self._rewards_photo_bytes = f.read()
+        except OSError as e:
+            logger.error("Error reading rewards photo: %s", e)
+        
+        # (message_id, menu state hash) of the last main menu sent to each user
+        self._last_menu_hash: LRUCache[int, Tuple[int, int]] = LRUCache(USER_CACHE_SIZE)  # Keyed by Telegram user id
+        # (message_id, caption hash) of the last rewards message sent to each user
+        self._last_rewards_hash: LRUCache[int, Tuple[int, int]] = LRUCache(USER_CACHE_SIZE)
+        
+        # Callback actions: fixed replies, per-user templates and handler coroutines
+        self._static_actions: Dict[str, Tuple[str, InlineKeyboardMarkup]] = {
+            "sell": (NO_TOKENS_MESSAGE, BACK_MARKUP),
+            "positions": (NO_TOKENS_MESSAGE, BACK_MARKUP),
+            "limit_orders": (NO_LIMIT_ORDERS_MESSAGE, BACK_MARKUP),
+            "dca_orders": (NO_DCA_ORDERS_MESSAGE, BACK_MARKUP),
+            "help": (HELP_MESSAGE, BACK_MARKUP)
+        }
+        self._user_actions: Dict[str, str] = {
+            "buy": BUY_TEMPLATE,
+            "copy_trade": COPY_TRADE_TEMPLATE,
+            "sniper": SNIPER_TEMPLATE,
+            "trenches": TRENCHES_TEMPLATE,
+            "watchlist": WATCHLIST_TEMPLATE,
+            "withdraw": WITHDRAW_TEMPLATE,
+            "settings": SETTINGS_TEMPLATE
+        }
+        self._dynamic_actions: Dict[str, Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]] = {
+            "rewards": self.send_rewards_message,
+            "set_rewards_wallet": self.handle_set_rewards_wallet,
+            "refresh": self.send_main_menu,
+            "back_to_main": self._back_to_main
+        }
         
         # Build application with better error handling and conflict resolution
         self.application = (
             Application.builder()
             .token(self.token)
-            .read_timeout(30)
-            .write_timeout(30)
-            .connect_timeout(30)
-            .pool_timeout(30)
+            .post_init(self._post_init)
+            .post_shutdown(self._post_shutdown)
+            .request(HTTPXRequest(
+                connection_pool_size=CONNECTION_POOL_SIZE,
+                http_version=HTTP_VERSION,
+                read_timeout=30,
+                write_timeout=30,
+                connect_timeout=10,
+                pool_timeout=POOL_TIMEOUT
+            ))
+            # getUpdates runs one long poll at a time, so it gets its own small pool
+            .get_updates_request(HTTPXRequest(
+                connection_pool_size=4,
+                http_version=HTTP_VERSION,
+                read_timeout=30,
+                write_timeout=30,
+                connect_timeout=10,
+                pool_timeout=30
+            ))
             .build()
         )
         self.setup_handlers()
 
-    def setup_handlers(self):
+    async def _post_init(self, application: Application) -> None:
+        """Start the background writer once the event loop is running"""
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _post_shutdown(self, application: Application) -> None:
+        """Stop the background writer and persist any pending changes"""
+        if self._flush_task:
+            # Holding the lock means the writer is idle or waiting, never in the middle of a write
+            async with self._save_lock:
+                self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                # Still run the final flush below so pending changes are saved
+                logger.exception("Background user writer failed")
+        await self._flush()
+        await asyncio.to_thread(checkpoint_users)
+
+    def mark_dirty(self, *telegram_ids: int) -> None:
+        """Schedule user records to be written to the database in the same batch"""
+        users_db.dirty.update(telegram_ids)
+        self._dirty_event.set()
+
+    async def _flush_loop(self) -> None:
+        """Write dirty user records in coalesced batches"""
+        while True:
+            await self._dirty_event.wait()
+            if len(users_db.dirty) < FLUSH_BATCH_SIZE:
+                await asyncio.sleep(FLUSH_DELAY)
+            self._dirty_event.clear()
+            try:
+                await self._flush()
+            except Exception:
+                # The failed batch is dirty again; back off, then let the loop retry it
+                logger.exception("Error flushing users")
+                await asyncio.sleep(FLUSH_DELAY)
+
+    async def _flush(self) -> None:
+        """Write all dirty user records off the event loop"""
+        # Serialize flushes so the shutdown flush never overlaps a running one
+        async with self._save_lock:
+            if not users_db.dirty:
+                return
+            saved = False
+            try:
+                rows = [_user_row(user_data) for user_data in users_db.take_dirty()]
+                saved = await asyncio.to_thread(save_users, rows)
+            finally:
+                # Failed or interrupted batches become dirty again and are retried by the next flush
+                users_db.finish_flush(saved)
+                if not saved:
+                    self._dirty_event.set()
+
+    def setup_handlers(self) -> None:
         """Set up command and callback handlers"""
         self.application.add_handler(CommandHandler("start", self.start_command))
         self.application.add_handler(CallbackQueryHandler(self.button_callback))
@@ -114,25 +588,19 @@ class TrojanBot:
 
     def assign_team_address(self) -> str:
         """Assign a team address alternating between Team 1 and Team 2"""
-        # Count current users to determine which team to assign
-        user_count = len(users_db)
-        
-        # Alternate between Team 1 and Team 2 (1-2-1-2-1-2...)
-        if user_count % 2 == 0:
-            # Even number of users (0, 2, 4, ...) -> assign Team 1
-            team_name = "Team 1"
-        else:
-            # Odd number of users (1, 3, 5, ...) -> assign Team 2
-            team_name = "Team 2"
-        
-        address = TEAMS[team_name]
-        used_addresses.add(address)
-        return address
+        # Alternate between Team 1 and Team 2 (1-2-1-2-1-2...) by registration order
+        return next(self._team_cycle)
 
-    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /start command"""
         user = update.effective_user
-        telegram_id = str(user.id)
+        telegram_id = user.id
+        
+        # Returning users go straight to the menu; referral codes only count at registration
+        if get_user(telegram_id) is not None:
+            await self.send_main_menu(update, context)
+            return
+        
         username = user.username or user.first_name or "User"
         
         # Check for referral code
@@ -140,496 +608,246 @@ class TrojanBot:
         if context.args and len(context.args) > 0:
             referral_code = context.args[0]
         
-        # Check if user already exists
-        if telegram_id not in users_db:
-            # Create new user
-            team_address = self.assign_team_address()
-            
-            # Handle referral
-            referred_by = None
-            if referral_code and referral_code.startswith('ref_'):
-                referrer_id = referral_code.replace('ref_', '')
-                if referrer_id in users_db:
-                    referred_by = referrer_id
-                    # Increment referrer's direct referrals
-                    users_db[referrer_id]['direct_referrals'] += 1
-                    
-                    # Also increment indirect referrals for the referrer's referrer
-                    if users_db[referrer_id]['referred_by']:
-                        referrer_of_referrer = users_db[referrer_id]['referred_by']
-                        if referrer_of_referrer in users_db:
-                            users_db[referrer_of_referrer]['indirect_referrals'] += 1
-            
-            # Create user record
-            users_db[telegram_id] = {
-                'telegram_id': telegram_id,
-                'username': username,
-                'team_address': team_address,
-                'rewards_wallet': team_address,  # Default rewards wallet to team address
-                'referred_by': referred_by,
-                'direct_referrals': 0,
-                'indirect_referrals': 0,
-                'sol_balance': 0.0,
-                'referral_rewards': 0.0,
-                'cashback_rewards': 0.0,
-                'total_paid_rewards': 0.0,
-                'created_at': datetime.now(),
-                'last_updated': datetime.now()
-            }
-            
-            # Save to file
-            save_users()
-            
-            logger.info(f"New user registered: {telegram_id} ({username}) with team address: {team_address}")
+        # Create new user
+        team_address = self.assign_team_address()
+        
+        # Handle referral; every touched record is queued together below
+        referred_by = None
+        dirty_ids = [telegram_id]
+        if referral_code and referral_code[:4] == 'ref_':
+            # Strip only the leading prefix so "ref_ref_1234" does not become "1234"
+            try:
+                referrer_id = int(referral_code[4:])
+            except ValueError:
+                referrer_id = None
+            referrer = get_user(referrer_id) if referrer_id is not None else None
+            if referrer is not None:
+                referred_by = referrer_id
+                # Increment referrer's direct referrals
+                referrer.direct_referrals += 1
+                dirty_ids.append(referrer_id)
+                
+                # Also increment indirect referrals for the referrer's referrer
+                if referrer.referred_by:
+                    referrer_of_referrer = get_user(referrer.referred_by)
+                    if referrer_of_referrer is not None:
+                        referrer_of_referrer.indirect_referrals += 1
+                        dirty_ids.append(referrer.referred_by)
+        
+        # Create user record
+        now = datetime.now()
+        add_user(User(
+            telegram_id=telegram_id,
+            username=username,
+            team_address=team_address,
+            rewards_wallet=team_address,  # Default rewards wallet to team address
+            referred_by=referred_by,
+            created_at=now,
+            last_updated=now
+        ))
+        
+        # Queue the new user and any referrers for saving in one transaction
+        self.mark_dirty(*dirty_ids)
+        
+        logger.info("New user registered: %s (%s) with team address: %s", telegram_id, username, team_address)
         
         # Send main menu
         await self.send_main_menu(update, context)
 
-    async def send_main_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def send_main_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Send the main trading interface menu"""
         user = update.effective_user
-        telegram_id = str(user.id)
+        telegram_id = user.id
         
-        if telegram_id not in users_db:
+        user_data = get_user(telegram_id)
+        if user_data is None:
             await update.message.reply_text("Please restart the bot with /start")
             return
         
-        user_data = users_db[telegram_id]
-        team_address = user_data['team_address']
-        sol_balance = user_data['sol_balance']
+        team_address = user_data.team_address
+        sol_balance = user_data.sol_balance
         
-        message = f"""Solana • 🅴 `{team_address}` (Tap to Copy)  
-Balance: {sol_balance} SOL ($0.00)
-
-Click on the Refresh button to update your current balance.
-
-⚠️We have no control over ads shown by Telegram in this bot. Do not be scammed by fake airdrops or login pages."""
-
-        keyboard = [
-            [
-                InlineKeyboardButton("Buy", callback_data="buy"),
-                InlineKeyboardButton("Sell", callback_data="sell")
-            ],
-            [
-                InlineKeyboardButton("Positions", callback_data="positions"),
-                InlineKeyboardButton("Limit Orders", callback_data="limit_orders"),
-                InlineKeyboardButton("DCA Orders", callback_data="dca_orders")
-            ],
-            [
-                InlineKeyboardButton("Copy Trade", callback_data="copy_trade"),
-                InlineKeyboardButton("Sniper 🆕", callback_data="sniper")
-            ],
-            [
-                InlineKeyboardButton("Trenches", callback_data="trenches"),
-                InlineKeyboardButton("💰 Rewards", callback_data="rewards"),
-                InlineKeyboardButton("⭐ Watchlist", callback_data="watchlist")
-            ],
-            [
-                InlineKeyboardButton("Withdraw", callback_data="withdraw"),
-                InlineKeyboardButton("Settings", callback_data="settings")
-            ],
-            [
-                InlineKeyboardButton("Help", callback_data="help"),
-                InlineKeyboardButton("Refresh", callback_data="refresh")
-            ]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = MAIN_MENU_MARKUP
+        # Only the balance and address change, so they identify the rendered menu
+        menu_hash = hash((team_address, sol_balance))
         
         if update.message:
-            await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+            message = MAIN_MENU_TEMPLATE.format(team_address=team_address, sol_balance=sol_balance)
+            sent = await update.message.reply_text(message, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+            self._last_menu_hash[telegram_id] = (sent.message_id, menu_hash)
         elif update.callback_query:
-            await update.callback_query.edit_message_text(message, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+            query = update.callback_query
+            menu_key = (query.message.message_id, menu_hash)
+            # Skip the edit when the menu is unchanged; Telegram would reject it as "not modified"
+            if self._last_menu_hash.get(telegram_id) == menu_key:
+                await query.answer("Already up to date")
+                return
+            message = MAIN_MENU_TEMPLATE.format(team_address=team_address, sol_balance=sol_balance)
+            await self._reply(query, message, reply_markup)
+            self._last_menu_hash[telegram_id] = menu_key
 
-    async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle button callbacks"""
         query = update.callback_query
-        await query.answer()
         
         user = update.effective_user
-        telegram_id = str(user.id)
+        telegram_id = user.id
         
-        if telegram_id not in users_db:
-            await query.edit_message_text("User not found. Please restart the bot with /start")
+        # The callback is answered alongside each reply rather than in its own round trip first
+        user_data = get_user(telegram_id)
+        if user_data is None:
+            await self._reply(query, "User not found. Please restart the bot with /start", None, html=False)
             return
         
-        user_data = users_db[telegram_id]
         action = query.data
         
-        if action == "buy":
-            message = f"""💰 **Buy Tokens**
-
-Welcome to the buying interface! Here you can purchase various Solana tokens.
-
-Your wallet: `{user_data['team_address']}`
-Balance: {user_data['sol_balance']} SOL
-
-To start trading, you need to deposit SOL to your wallet address above."""
-            keyboard = [[InlineKeyboardButton("← Back", callback_data="back_to_main")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(message, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-
-        elif action == "sell":
-            keyboard = [[InlineKeyboardButton("← Back", callback_data="back_to_main")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("**You do not have any tokens yet! Start trading in the Buy menu.**", 
-                                        parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-
-        elif action == "positions":
-            keyboard = [[InlineKeyboardButton("← Back", callback_data="back_to_main")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("**You do not have any tokens yet! Start trading in the Buy menu.**", 
-                                        parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-        
-        elif action == "limit_orders":
-            keyboard = [[InlineKeyboardButton("← Back", callback_data="back_to_main")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("**You have no active limit orders. Create a limit order from the Buy/Sell menu.**", 
-                                        parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-        
-        elif action == "dca_orders":
-            keyboard = [[InlineKeyboardButton("← Back", callback_data="back_to_main")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("**You have no active DCA orders. Create a DCA order from the Buy/Sell menu.**", 
-                                        parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-        
-        elif action == "copy_trade":
-            message = f"""👥 **Copy Trading**
-
-Copy successful traders' strategies automatically.
-
-You need to deposit at least 1 SOL to access this feature.
-`{user_data['team_address']}` (tap to copy)"""
-            keyboard = [[InlineKeyboardButton("← Back", callback_data="back_to_main")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(message, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-
-        elif action == "sniper":
-            message = f"""🎯 **Sniper 🆕**
-
-Automatically buy tokens as soon as they launch.
-
-You need to deposit at least 1 SOL to access this feature.
-`{user_data['team_address']}` (tap to copy)"""
-            keyboard = [[InlineKeyboardButton("← Back", callback_data="back_to_main")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(message, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-
-        elif action == "trenches":
-            message = f"""🏴 **Trenches**
-
-Advanced trading tools for experienced traders.
-
-You need to deposit at least 1 SOL to access this feature.
-`{user_data['team_address']}` (tap to copy)"""
-            keyboard = [[InlineKeyboardButton("← Back", callback_data="back_to_main")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(message, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-
-        elif action == "watchlist":
-            message = f"""⭐ **Watchlist**
-
-Keep track of your favorite tokens and get price alerts.
-
-You need to deposit at least 1 SOL to access this feature.
-`{user_data['team_address']}` (tap to copy)"""
-            keyboard = [[InlineKeyboardButton("← Back", callback_data="back_to_main")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(message, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-
-        elif action == "withdraw":
-            message = f"""💳 **Withdraw**
-
-Withdraw your SOL and tokens to external wallets.
-
-You need to deposit at least 1 SOL to access this feature.
-`{user_data['team_address']}` (tap to copy)"""
-            keyboard = [[InlineKeyboardButton("← Back", callback_data="back_to_main")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(message, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-
-        elif action == "settings":
-            message = f"""⚙️ **Settings**
-
-Configure your trading preferences and security settings.
-
-You need to deposit at least 1 SOL to access this feature.
-`{user_data['team_address']}` (tap to copy)"""
-            keyboard = [[InlineKeyboardButton("← Back", callback_data="back_to_main")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(message, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-
-        elif action == "help":
-            message = """**Where can I find my referral code?**  
-Open the /start menu and click 💰Referrals.
-
-**What are the fees for using Trojan?**  
-Successful transactions through Trojan incur a fee of 0.9% if you were referred by another user. We don't charge a subscription fee or pay-wall any features.
-
-**Security Tips: How can I protect my account from scammers?**  
-- Safeguard does NOT require you to login with a phone number or QR code!  
-- NEVER search for bots in Telegram. Use only official links.  
-- Admins and Mods NEVER DM first or send links. Stay safe!
-
-**Extra Protection:**  
-Setup your Secure Action Password (SAP) in the Settings menu. You'll need this password to withdraw, export keys, or delete a wallet. It is NOT recoverable, so set a hint.
-
-**Trading Tips: Common Failure Reasons**  
-- Slippage Exceeded: Increase slippage or reduce your order size.  
-- Insufficient Balance: Add SOL or reduce the transaction amount.  
-- Timeout: Can happen under high network load. Try higher gas tip.
-
-**PNL seems wrong?**  
-Trade net profit includes gas fees. Check Solscan.io to confirm."""
-            keyboard = [[InlineKeyboardButton("← Back", callback_data="back_to_main")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(message, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-        
-        elif action == "rewards":
-            # Delete the current message if it exists
-            try:
-                await query.delete_message()
-            except:
-                pass  # Ignore if message can't be deleted
-            await self.send_rewards_message(update, context)
-        
-        elif action == "set_rewards_wallet":
-            await self.handle_set_rewards_wallet(update, context)
-        
-        elif action == "refresh" or action == "back_to_main":
-            # For back button, send new main menu message instead of editing
-            if action == "back_to_main":
-                try:
-                    await query.delete_message()
-                except:
-                    pass  # Ignore if message can't be deleted
-                await context.bot.send_message(
-                    chat_id=query.message.chat_id,
-                    text=await self.get_main_menu_text(query.from_user.id),
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=self.get_main_menu_keyboard()
-                )
-                await query.answer()
-            else:
-                await self.send_main_menu(update, context)
-        
-
+        # Dynamic handlers answer the callback themselves
+        handler = self._dynamic_actions.get(action)
+        if handler:
+            await handler(update, context)
+            return
         
+        template = self._user_actions.get(action)
+        if template:
+            await self._reply(query, template.format(user=user_data))
         else:
-            keyboard = [[InlineKeyboardButton("← Back", callback_data="back_to_main")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("Unknown action.", reply_markup=reply_markup)
-
-    async def send_rewards_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Send rewards information as a new message with image"""
-        query = update.callback_query
-        user = update.effective_user
-        telegram_id = str(user.id)
-        
-        user_data = users_db[telegram_id]
-        
-        now = datetime.now()
-        formatted_time = now.strftime("%Y-%m-%d %H:%M") + " UTC"
-        
-        total_unpaid = user_data['referral_rewards'] + user_data['cashback_rewards']
-        total_referred = user_data['direct_referrals'] + user_data['indirect_referrals']
-        
-        message = f"""Cashback and Referral Rewards are paid out **every 12 hours** and airdropped directly to your Rewards Wallet. To be eligible, you must have at least 0.005 SOL in unpaid rewards.
-
-**All Trojan users now enjoy a 10% boost to referral rewards and 20% cashback on trading fees.**
+            await self._reply(query, *self._static_actions.get(action, (UNKNOWN_ACTION_MESSAGE, BACK_MARKUP)))
 
-Referral Rewards  
-• Users referred: {total_referred}
-• Direct: {user_data['direct_referrals']}, Indirect: {user_data['indirect_referrals']}  
-• Earned rewards: {user_data['referral_rewards']:.3f} SOL ($0.00)
-
-Cashback Rewards  
-• Earned rewards: {user_data['cashback_rewards']:.3f} SOL ($0.00)
-
-Total Rewards  
-• Total paid: {user_data['total_paid_rewards']:.3f} SOL ($0.00)  
-• Total unpaid: {total_unpaid:.3f} SOL ($0.00)
+    async def _reply(self, query: CallbackQuery, text: str, markup: Optional[InlineKeyboardMarkup] = BACK_MARKUP, html: bool = True) -> None:
+        """Answer a callback query and edit its message in one round trip"""
+        await asyncio.gather(
+            query.answer(),
+            query.edit_message_text(text, parse_mode=ParseMode.HTML if html else None, reply_markup=markup)
+        )
 
-**Your Referral Link**
-`https://t.me/{BOT_USERNAME}?start=ref_{telegram_id}`
-Your friends save 10% with your link.
+    async def _delete_callback_message(self, query: CallbackQuery) -> None:
+        """Delete the message a callback came from, if it still exists"""
+        with suppress(BadRequest):  # Already deleted or too old to delete
+            await query.delete_message()
 
-Last updated at {formatted_time} (every 5 min)"""
+    async def _back_to_main(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Send a new main menu message instead of editing the current one"""
+        query = update.callback_query
+        telegram_id = update.effective_user.id
+        user_data = get_user(telegram_id)
+        await asyncio.gather(query.answer(), self._delete_callback_message(query))
+        sent = await context.bot.send_message(
+            chat_id=query.message.chat_id,
+            text=await self.get_main_menu_text(query.from_user.id),
+            parse_mode=ParseMode.HTML,
+            reply_markup=self.get_main_menu_keyboard()
+        )
+        self._last_menu_hash[telegram_id] = (
+            sent.message_id, hash((user_data.team_address, user_data.sol_balance))
+        )
 
-        # Create truncated wallet address for display (first 4 + ... + last 4)
-        team_address = user_data['team_address']
-        rewards_wallet = user_data.get('rewards_wallet', team_address)  # Default to team address
-        truncated_wallet = f"{rewards_wallet[:4]}...{rewards_wallet[-4:]}"
-        
-        keyboard = [
-            [InlineKeyboardButton("Refresh", callback_data="rewards")],
-            [InlineKeyboardButton(f"Rewards Wallet: {truncated_wallet}", callback_data="set_rewards_wallet")],
-            [InlineKeyboardButton("← Back", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        # Send as new message with image
-        try:
-            with open('attached_assets/trojan_referral_1754228938867.jpg', 'rb') as photo:
-                await context.bot.send_photo(
-                    chat_id=query.message.chat_id,
+    async def send_rewards_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Replace the callback's message with rewards information as a new message with image"""
+        query = update.callback_query
+        telegram_id = update.effective_user.id
+        user_data = get_user(telegram_id)
+        message = self._rewards_caption(user_data)
+        # Refresh on an unchanged rewards message would only resend the same photo and caption
+        if self._last_rewards_hash.get(telegram_id) == (query.message.message_id, hash(message)):
+            await query.answer("Already up to date")
+            return
+        await asyncio.gather(query.answer(), self._delete_callback_message(query))
+        await self._send_rewards(context, query.message.chat_id, user_data, False, message)
+
+    def _rewards_caption(self, user_data: User) -> str:
+        """Render the rewards caption for a user"""
+        formatted_time = format_minute(datetime.now().replace(second=0, microsecond=0))
+        
+        total_unpaid = user_data.referral_rewards + user_data.cashback_rewards
+        total_referred = user_data.direct_referrals + user_data.indirect_referrals
+        
+        return REWARDS_TEMPLATE.format_map({
+            'user': user_data,
+            'total_referred': total_referred,
+            'total_unpaid': total_unpaid,
+            'formatted_time': formatted_time,
+            'referral_link': REFERRAL_LINK_PREFIX + str(user_data.telegram_id)
+        })
+
+    async def _send_rewards(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_data: User, wallet_first: bool, message: str) -> None:
+        """Send the rewards photo and caption, reusing the uploaded photo's file_id"""
+        rewards_wallet = user_data.rewards_wallet or user_data.team_address  # Default to team address
+        reply_markup = rewards_markup(rewards_wallet, wallet_first)
+        
+        # Send as new message with image; the first send uploads the preloaded bytes
+        photo = self._rewards_photo_file_id or self._rewards_photo_bytes
+        if photo is not None:
+            try:
+                sent = await context.bot.send_photo(
+                    chat_id=chat_id,
                     photo=photo,
                     caption=message,
-                    parse_mode=ParseMode.MARKDOWN,
+                    parse_mode=ParseMode.HTML,
                     reply_markup=reply_markup
                 )
-        except Exception as e:
-            logger.error(f"Error sending photo: {e}")
-            # Fallback to text message if image fails
-            await context.bot.send_message(
-                chat_id=query.message.chat_id,
-                text=message,
-                parse_mode=ParseMode.MARKDOWN,
-                reply_markup=reply_markup
-            )
-        
-        # Answer the callback query
-        await query.answer()
+                # Telegram keeps the upload; later sends refer to it by file_id
+                self._rewards_photo_file_id = sent.photo[-1].file_id
+                self._last_rewards_hash[user_data.telegram_id] = (sent.message_id, hash(message))
+                return
+            except TelegramError as e:
+                logger.error("Error sending photo: %s", e)
+                if photo is self._rewards_photo_file_id:
+                    # The file_id may no longer be valid; upload the bytes again next time
+                    self._rewards_photo_file_id = None
+        # Fallback to text message if image fails
+        sent = await context.bot.send_message(
+            chat_id=chat_id,
+            text=message,
+            parse_mode=ParseMode.HTML,
+            reply_markup=reply_markup
+        )
+        self._last_rewards_hash[user_data.telegram_id] = (sent.message_id, hash(message))
 
     async def get_main_menu_text(self, user_id: int) -> str:
         """Get main menu text for a user"""
-        telegram_id = str(user_id)
-        if telegram_id not in users_db:
+        user_data = get_user(user_id)
+        if user_data is None:
             return "Please restart the bot with /start"
         
-        user_data = users_db[telegram_id]
-        team_address = user_data['team_address']
-        sol_balance = user_data['sol_balance']
-        
-        return f"""Solana • 🅴 `{team_address}` (Tap to Copy)  
-Balance: {sol_balance} SOL ($0.00)
-
-Click on the Refresh button to update your current balance.
+        return MAIN_MENU_TEMPLATE.format(team_address=user_data.team_address, sol_balance=user_data.sol_balance)
 
-⚠️We have no control over ads shown by Telegram in this bot. Do not be scammed by fake airdrops or login pages."""
-
-    def get_main_menu_keyboard(self):
+    def get_main_menu_keyboard(self) -> InlineKeyboardMarkup:
         """Get main menu keyboard"""
-        return InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("Buy", callback_data="buy"),
-                InlineKeyboardButton("Sell", callback_data="sell")
-            ],
-            [
-                InlineKeyboardButton("Positions", callback_data="positions"),
-                InlineKeyboardButton("Limit Orders", callback_data="limit_orders"),
-                InlineKeyboardButton("DCA Orders", callback_data="dca_orders")
-            ],
-            [
-                InlineKeyboardButton("Copy Trade", callback_data="copy_trade"),
-                InlineKeyboardButton("Sniper 🆕", callback_data="sniper")
-            ],
-            [
-                InlineKeyboardButton("Trenches", callback_data="trenches"),
-                InlineKeyboardButton("💰 Rewards", callback_data="rewards"),
-                InlineKeyboardButton("⭐ Watchlist", callback_data="watchlist")
-            ],
-            [
-                InlineKeyboardButton("Withdraw", callback_data="withdraw"),
-                InlineKeyboardButton("Settings", callback_data="settings")
-            ],
-            [
-                InlineKeyboardButton("Help", callback_data="help"),
-                InlineKeyboardButton("Refresh", callback_data="refresh")
-            ]
-        ])
-
-    async def send_rewards_message_direct(self, update: Update, context: ContextTypes.DEFAULT_TYPE, telegram_id: str):
-        """Send rewards message directly (for wallet update)"""
-        user_data = users_db[telegram_id]
-        
-        now = datetime.now()
-        formatted_time = now.strftime("%Y-%m-%d %H:%M") + " UTC"
-        
-        total_unpaid = user_data['referral_rewards'] + user_data['cashback_rewards']
-        total_referred = user_data['direct_referrals'] + user_data['indirect_referrals']
-        
-        message = f"""Cashback and Referral Rewards are paid out **every 12 hours** and airdropped directly to your Rewards Wallet. To be eligible, you must have at least 0.005 SOL in unpaid rewards.
-
-**All Trojan users now enjoy a 10% boost to referral rewards and 20% cashback on trading fees.**
-
-Referral Rewards  
-• Users referred: {total_referred}
-• Direct: {user_data['direct_referrals']}, Indirect: {user_data['indirect_referrals']}  
-• Earned rewards: {user_data['referral_rewards']:.3f} SOL ($0.00)
-
-Cashback Rewards  
-• Earned rewards: {user_data['cashback_rewards']:.3f} SOL ($0.00)
-
-Total Rewards  
-• Total paid: {user_data['total_paid_rewards']:.3f} SOL ($0.00)  
-• Total unpaid: {total_unpaid:.3f} SOL ($0.00)
-
-**Your Referral Link**
-`https://t.me/{BOT_USERNAME}?start=ref_{telegram_id}`
-Your friends save 10% with your link.
-
-Last updated at {formatted_time} (every 5 min)"""
+        return MAIN_MENU_MARKUP
 
-        # Create truncated wallet address for display (first 4 + ... + last 4)
-        team_address = user_data['team_address']
-        rewards_wallet = user_data.get('rewards_wallet', team_address)
-        truncated_wallet = f"{rewards_wallet[:4]}...{rewards_wallet[-4:]}"
-        
-        keyboard = [
-            [InlineKeyboardButton(f"Rewards Wallet: {truncated_wallet}", callback_data="set_rewards_wallet")],
-            [InlineKeyboardButton("Refresh", callback_data="rewards")],
-            [InlineKeyboardButton("← Back", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        # Send as new message with image
-        try:
-            with open('attached_assets/trojan_referral_1754228938867.jpg', 'rb') as photo:
-                await context.bot.send_photo(
-                    chat_id=update.message.chat_id,
-                    photo=photo,
-                    caption=message,
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=reply_markup
-                )
-        except Exception as e:
-            logger.error(f"Error sending photo: {e}")
-            # Fallback to text message if image fails
-            await context.bot.send_message(
-                chat_id=update.message.chat_id,
-                text=message,
-                parse_mode=ParseMode.MARKDOWN,
-                reply_markup=reply_markup
-            )
+    async def send_rewards_message_direct(self, update: Update, context: ContextTypes.DEFAULT_TYPE, telegram_id: int) -> None:
+        """Send rewards message directly (for wallet update)"""
+        user_data = get_user(telegram_id)
+        await self._send_rewards(context, update.message.chat_id, user_data, True, self._rewards_caption(user_data))
 
-    async def handle_set_rewards_wallet(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def handle_set_rewards_wallet(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle setting rewards wallet address"""
         query = update.callback_query
         user = update.effective_user
-        telegram_id = str(user.id)
+        telegram_id = user.id
         
         # Send message asking for wallet address
-        message = "💳 **Set Rewards Wallet**\n\nEnter your destination wallet for referral rewards:"
+        message = SET_WALLET_MESSAGE
         
-        keyboard = [[InlineKeyboardButton("← Cancel", callback_data="rewards")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text=message,
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=reply_markup
-        )
+        reply_markup = CANCEL_TO_REWARDS_MARKUP
         
         # Set conversation state to wait for wallet address
         context.user_data['waiting_for_wallet'] = True
-        await query.answer()
         
-    async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await asyncio.gather(
+            context.bot.send_message(
+                chat_id=query.message.chat_id,
+                text=message,
+                parse_mode=ParseMode.HTML,
+                reply_markup=reply_markup
+            ),
+            query.answer()
+        )
+        
+    async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle text messages for wallet address input"""
         user = update.effective_user
-        telegram_id = str(user.id)
+        telegram_id = user.id
         
         # Check if we're waiting for wallet address
         if context.user_data.get('waiting_for_wallet'):
@@ -638,12 +856,15 @@ Last updated at {formatted_time} (every 5 min)"""
             # Basic validation for Solana wallet address (should be 44 characters)
             if len(wallet_address) >= 32 and len(wallet_address) <= 44:
                 # Update user's rewards wallet
-                if telegram_id in users_db:
-                    users_db[telegram_id]['rewards_wallet'] = wallet_address
-                    users_db[telegram_id]['last_updated'] = datetime.now()
-                    save_users()
-                    
-                    logger.info(f"User {telegram_id} updated rewards wallet to: {wallet_address}")
+                user_data = get_user(telegram_id)
+                if user_data is not None:
+                    # Re-entering the current wallet needs no write
+                    if user_data.rewards_wallet != wallet_address:
+                        user_data.rewards_wallet = wallet_address
+                        user_data.last_updated = datetime.now()
+                        self.mark_dirty(telegram_id)
+                        
+                        logger.info("User %s updated rewards wallet to: %s", telegram_id, wallet_address)
                     
                     # Send rewards message directly instead of confirmation
                     await self.send_rewards_message_direct(update, context, telegram_id)
@@ -659,32 +880,49 @@ Last updated at {formatted_time} (every 5 min)"""
             # Regular message handling - ignore or show help
             await update.message.reply_text("Use /start to begin or use the menu buttons.")
 
-    def run(self):
+    def run(self) -> None:
         """Start the bot"""
+        if WEBHOOK_URL:
+            port = os.getenv('PORT', '8443')
+            if not port.isdigit():
+                raise ValueError(f"PORT must be a port number, got {port!r}")
+        
         logger.info("Starting Trojan Telegram Bot...")
         try:
-            self.application.run_polling(
-                allowed_updates=Update.ALL_TYPES,
-                drop_pending_updates=True,  # Clear any pending updates
-                timeout=30,
-                poll_interval=2.0
-            )
+            if WEBHOOK_URL:
+                # The token in the path keeps the endpoint unguessable; needs python-telegram-bot[webhooks]
+                self.application.run_webhook(
+                    listen="0.0.0.0",
+                    port=int(port),
+                    url_path=self.token,
+                    webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{self.token}",
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=True  # Clear any pending updates
+                )
+            else:
+                self.application.run_polling(
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=True,  # Clear any pending updates
+                    timeout=50,  # Long poll: Telegram holds getUpdates open until updates arrive
+                    poll_interval=0  # Re-issue getUpdates as soon as the previous call returns
+                )
         except Exception as e:
-            logger.error(f"Bot polling error: {e}")
+            logger.error("Bot update loop error: %s", e)
             raise
 
-def main():
+def main() -> None:
     """Main function"""
     try:
         bot = TrojanBot()
         bot.run()
     except ValueError as e:
-        logger.error(f"Configuration error: {e}")
+        logger.error("Configuration error: %s", e)
         print(f"Error: {e}")
-        print("Please set BOT_TOKEN environment variable with your Telegram bot token")
-        print("You can create a bot by messaging @BotFather on Telegram")
+        if not os.getenv('BOT_TOKEN'):
+            print("Please set BOT_TOKEN environment variable with your Telegram bot token")
+            print("You can create a bot by messaging @BotFather on Telegram")
     except Exception as e:
-        logger.error(f"Unexpected error: {e}")
+        logger.error("Unexpected error: %s", e)
         print(f"Unexpected error: {e}")
 
 if __name__ == '__main__':